@@ -0,0 +1,172 @@
+#
+# Persistent AMQP publisher with publisher confirms.
+#
+# publish() only queues the message, so it never blocks the caller.  A
+# thread owns the connection (a pika SelectConnection), and every flush
+# interval sends everything queued since the last tick.  The channel is in
+# confirm mode: a message is kept until the broker acks it, and messages
+# still unconfirmed when the connection is lost (or nacked) are sent again
+# after reconnecting.
+#
+# Queued and unconfirmed messages together are bounded by max_buffer; when
+# full, the oldest queued message is dropped.
+#
+# amqp_publish_ms is the time from sending a message to its confirm, and
+# amqp_retries counts reconnect attempts, failed publishes and messages sent
+# again.
+#
+import time
+import threading
+import traceback
+from collections import deque, OrderedDict
+
+import pika
+import pika.spec
+
+from ingest_stats import stats
+
+FLUSH_INTERVAL = 0.05
+RECONNECT_SECONDS = 3
+MAX_BUFFER = 100000
+
+
+class AmqpPublisher(threading.Thread):
+    def __init__(self, url, interval=FLUSH_INTERVAL, max_buffer=MAX_BUFFER):
+        threading.Thread.__init__(self, name='amqp-publisher')
+        self.daemon = True
+        self._parameters = pika.URLParameters(url)
+        self._interval = interval
+        self._max_buffer = max_buffer
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._unconfirmed = OrderedDict()
+        self._connection = None
+        self._channel = None
+        self._tag = 0
+        self._closing = False
+        self.dropped = 0
+        stats.gauge('amqp_buffered', self.buffered)
+
+    def buffered(self):
+        return len(self._pending) + len(self._unconfirmed)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        with self._lock:
+            if len(self._pending) + len(self._unconfirmed) >= self._max_buffer:
+                self.dropped += 1
+                stats.incr('amqp_dropped')
+                if self.dropped % 1000 == 1:
+                    print "WARNING - amqp publisher is behind, dropped %d messages" % self.dropped
+                if not self._pending:
+                    return
+                self._pending.popleft()
+            self._pending.append((exchange, routing_key, body, properties))
+
+    #
+    # Sends what is still queued, and waits up to timeout seconds for it to
+    # be confirmed.
+    #
+    def close(self, timeout=5):
+        self._closing = True
+        self.join(timeout)
+        n = self.buffered()
+        if n:
+            print "WARNING - amqp publisher closed with %d messages unconfirmed" % n
+
+    def run(self):
+        while True:
+            try:
+                self._connection = pika.SelectConnection(self._parameters,
+                                                          on_open_callback=self._on_open,
+                                                          on_open_error_callback=self._on_open_error,
+                                                          on_close_callback=self._on_closed,
+                                                          stop_ioloop_on_close=False)
+                self._connection.ioloop.start()
+            except:
+                print "WARNING: amqp publisher exception: %s" % traceback.format_exc()
+            self._channel = None
+            self._requeue_unconfirmed()
+            if self._closing:
+                break
+            stats.incr('amqp_retries')
+            time.sleep(RECONNECT_SECONDS)
+
+    def _requeue_unconfirmed(self):
+        with self._lock:
+            if self._unconfirmed:
+                stats.incr('amqp_resent', len(self._unconfirmed))
+                stats.incr('amqp_retries', len(self._unconfirmed))
+                self._pending.extendleft(reversed([msg for msg, sent in self._unconfirmed.values()]))
+                self._unconfirmed = OrderedDict()
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_open_error(self, connection, error):
+        print "WARNING: could not connect to amqp, retrying in %d seconds: %s" % (RECONNECT_SECONDS, error)
+        connection.ioloop.stop()
+
+    def _on_closed(self, connection, reply_code, reply_text):
+        if not self._closing:
+            print "WARNING: amqp connection closed (%s %s), reconnecting in %d seconds" % (
+                reply_code, reply_text, RECONNECT_SECONDS)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_confirm)
+        stats.incr('amqp_connects')
+        self._flush()
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        self._channel = None
+        if self._connection.is_open:
+            if not self._closing:
+                print "WARNING: amqp channel closed (%s %s)" % (reply_code, reply_text)
+            self._connection.close()
+
+    def _on_confirm(self, frame):
+        tag = frame.method.delivery_tag
+        now = time.time()
+        with self._lock:
+            if frame.method.multiple:
+                msgs = []
+                while self._unconfirmed and next(iter(self._unconfirmed)) <= tag:
+                    msgs.append(self._unconfirmed.popitem(last=False)[1])
+            else:
+                msgs = [self._unconfirmed.pop(tag)] if tag in self._unconfirmed else []
+            if isinstance(frame.method, pika.spec.Basic.Nack):
+                stats.incr('amqp_nacked', len(msgs))
+                stats.incr('amqp_retries', len(msgs))
+                self._pending.extendleft(reversed([msg for msg, sent in msgs]))
+            else:
+                stats.incr('amqp_confirmed', len(msgs))
+        for msg, sent in msgs:
+            stats.observe('amqp_publish_ms', (now - sent) * 1000)
+
+    def _flush(self):
+        if not self._channel:
+            return
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+        sent = 0
+        try:
+            for msg in batch:
+                self._channel.basic_publish(msg[0], msg[1], msg[2], msg[3])
+                self._tag += 1
+                with self._lock:
+                    self._unconfirmed[self._tag] = (msg, time.time())
+                sent += 1
+        except:
+            print "WARNING: exception publishing to amqp: %s" % traceback.format_exc()
+            stats.incr('amqp_retries')
+            with self._lock:
+                self._pending.extendleft(reversed(batch[sent:]))
+        stats.incr('amqp_published', sent)
+        if self._closing and not self.buffered():
+            self._connection.close()
+        elif self._channel:
+            self._connection.add_timeout(self._interval, self._flush)
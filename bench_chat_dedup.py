@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Chat dedup throughput (messages/sec) at several duplicate ratios: the
+# chat_processor ChatDeduper against the previous heap and dateutil
+# implementation.
+#
+import sys
+import time
+import heapq
+import random
+import argparse
+import datetime
+
+import dateutil.parser
+
+from chat_processor import ChatDeduper
+
+# The dedup of chat_processor.ChatCallback before ChatDeduper.
+class HeapDeduper(object):
+    def __init__(self):
+        self._seen_messages = []
+        self._message_signatures = {}
+
+    def duplicate(self, time, riderid, msg):
+        if self._message_signatures.get(str(riderid) + msg, False):
+            return True
+        timestamp = dateutil.parser.parse(time)
+        while self._seen_messages and self._seen_messages[0][0] < timestamp - datetime.timedelta(seconds=3):
+            x = heapq.heappop(self._seen_messages)
+            del(self._message_signatures[str(x[1]['riderid']) + x[1]['msg']])
+        heapq.heappush(self._seen_messages, (timestamp, {'riderid':riderid, 'msg':msg}))
+        self._message_signatures[str(riderid) + msg] = True
+        return False
+
+#
+# n chat lines, about 20 a second, each unique line followed by copies
+# (from other monitors) so that dup_ratio of all lines are duplicates.
+#
+def sample_chat(n, dup_ratio):
+    lines = []
+    sec = 12 * 3600
+    copies = 1.0 / (1.0 - dup_ratio)
+    while len(lines) < n:
+        sec += random.random() < 0.05
+        t = '%d:%02d:%02d' % (sec / 3600 % 24, sec / 60 % 60, sec % 60)
+        line = (t, str(random.randint(1, 2000000)), 'ride on %d' % random.randint(1, 1000000))
+        k = int(copies) + (random.random() < copies - int(copies))
+        lines.extend([line] * k)
+    return lines[:n]
+
+def bench(deduper, lines):
+    start = time.time()
+    dups = 0
+    for t, riderid, msg in lines:
+        dups += deduper.duplicate(t, riderid, msg)
+    return len(lines) / (time.time() - start), dups
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Chat dedup benchmark')
+    parser.add_argument('-n', '--messages', type=int, default=200000, help='chat lines per run')
+    args = parser.parse_args()
+
+    print "%-6s %14s %14s %8s" % ('dups', 'heap msg/s', 'dedup msg/s', 'speedup')
+    for dup_ratio in (0.0, 0.5, 0.8, 0.9, 0.95):
+        lines = sample_chat(args.messages, dup_ratio)
+        old_rate, old_dups = bench(HeapDeduper(), lines)
+        new_rate, new_dups = bench(ChatDeduper(), lines)
+        if old_dups != new_dups:
+            print "WARNING - duplicates differ: %d vs %d" % (old_dups, new_dups)
+        print "%-6.2f %14.0f %14.0f %7.1fx" % (float(new_dups) / len(lines), old_rate, new_rate,
+                                               new_rate / old_rate)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Chat trigger throughput (messages/sec) with thousands of phrases: the
+# chat_triggers automaton against one compiled regex per phrase.
+#
+import re
+import sys
+import time
+import random
+import argparse
+
+from chat_triggers import TriggerMatcher
+
+WORDS = ('ride on nice pull sprint coming up attack watch out please stop drafting the race '
+         'marshal neutral zone wait for group sticky bottle kom banner finish line go hard '
+         'easy steady pace left right wheel gap bridge chase break lap').split()
+
+def sample_rules(n):
+    rules = []
+    for i in xrange(n):
+        phrase = ' '.join(random.sample(WORDS, random.randint(1, 2)) + ['w%d' % i])
+        rules.append(('rule%d' % (i % 50), phrase))
+    return rules
+
+def sample_chat(n, rules, hit_ratio):
+    lines = []
+    for i in xrange(n):
+        words = random.sample(WORDS, random.randint(2, 10))
+        if random.random() < hit_ratio:
+            words.insert(random.randint(0, len(words)), random.choice(rules)[1])
+        lines.append(' '.join(words))
+    return lines
+
+class RegexMatcher(object):
+    def __init__(self, rules):
+        self._rules = [(rule, phrase, re.compile(r'\b%s\b' % re.escape(phrase), re.IGNORECASE))
+                       for rule, phrase in rules]
+
+    def match(self, text):
+        return [(rule, phrase) for rule, phrase, r in self._rules if r.search(text)]
+
+def bench(matcher, lines):
+    start = time.time()
+    hits = 0
+    for line in lines:
+        hits += len(matcher.match(line))
+    return len(lines) / (time.time() - start), hits
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Chat trigger benchmark')
+    parser.add_argument('-n', '--messages', type=int, default=2000, help='chat lines per run')
+    parser.add_argument('--hits', type=float, default=0.1, help='fraction of lines with a trigger phrase')
+    args = parser.parse_args()
+
+    print "%-8s %10s %14s %14s %8s" % ('patterns', 'build ms', 'regex msg/s', 'automaton msg/s', 'speedup')
+    for n in (100, 1000, 5000, 10000):
+        rules = sample_rules(n)
+        lines = sample_chat(args.messages, rules, args.hits)
+        start = time.time()
+        matcher = TriggerMatcher(rules)
+        build_ms = (time.time() - start) * 1000
+        regex_rate, regex_hits = bench(RegexMatcher(rules), lines)
+        rate, hits = bench(matcher, lines)
+        if hits != regex_hits:
+            print "WARNING - matches differ: %d vs %d" % (hits, regex_hits)
+        print "%-8d %10.1f %14.0f %14.0f %7.1fx" % (n, build_ms, regex_rate, rate, rate / regex_rate)
+
+if __name__ == '__main__':
+    main(sys.argv)
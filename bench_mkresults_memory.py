@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# mkresults memory: peak RSS for a window of riders, each with a run of
+# positions and a finish record, built with the slotted mkresults classes
+# and with the same classes un-slotted (as they were before).  Each size
+# runs in its own process so peak RSS is not shared between runs.
+#
+import os
+import sys
+import types
+import random
+import argparse
+import subprocess
+
+import mkresults
+
+#
+# The classes as they were before __slots__: classic classes built from the
+# same methods, so each instance carries a __dict__.
+#
+def unslotted(cls):
+    ns = dict((k, v) for k, v in cls.__dict__.items()
+              if k not in cls.__slots__ and k not in ('__slots__', '__dict__', '__weakref__'))
+    return types.ClassType(cls.__name__, (), ns)
+
+def build(riders, positions, layout):
+    mkresults.args = argparse.Namespace(no_cat=False, columnar=False)
+    mkresults.conf = argparse.Namespace(finish_line_id=2, finish_forward=True, grace_ms=30000)
+    classes = (mkresults.rider, mkresults.pos, mkresults.grp_finish)
+    if layout == 'dict':
+        classes = [unslotted(cls) for cls in classes]
+    rider, pos, grp_finish = classes
+    t0 = 1500000000000
+    grp = argparse.Namespace(distance=positions * 200, start_ms=t0)
+    R = {}
+    for rider_id in xrange(1, riders + 1):
+        r = rider(rider_id)
+        r.set_info(('First', 'Last (%s)' % random.choice('ABCD'), None,
+                    random.randint(50000, 100000), 1800, 30, 1, 2))
+        t = t0 + random.randint(0, 60000)
+        meters = mwh = 0
+        for i in xrange(positions):
+            t += random.randint(20000, 60000)
+            meters += random.randint(200, 600)
+            mwh += random.randint(1000, 4000)
+            r.pos.append(pos((t, random.randint(1, 3), 1, meters, mwh, t - t0,
+                              100.0, random.randint(30000, 45000), 150)))
+        grp_finish(r, grp)
+        r.end = r.finish[0].pos or r.pos[-1]
+        R[rider_id] = r
+    return R
+
+def peak_rss_mb(riders, positions, layout):
+    p = subprocess.Popen([sys.executable, __file__, '--child', layout,
+                          '-r', str(riders), '-p', str(positions)])
+    _, status, usage = os.wait4(p.pid, 0)
+    if status:
+        raise SystemExit('child failed: %s' % layout)
+    return usage.ru_maxrss / 1024.0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'mkresults memory benchmark')
+    parser.add_argument('-p', '--positions', type=int, default=40, help='positions per rider')
+    parser.add_argument('-r', '--riders', type=int, help='single run with this many riders')
+    parser.add_argument('--child', choices=('dict', 'slots'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        build(args.riders, args.positions, args.child)
+        return
+
+    print "%-8s %10s %12s %12s %8s" % ('riders', 'positions', 'dict MB', 'slots MB', 'saved')
+    for n in ([args.riders] if args.riders else (1000, 10000, 50000)):
+        before = peak_rss_mb(n, args.positions, 'dict')
+        after = peak_rss_mb(n, args.positions, 'slots')
+        print "%-8d %10d %12.1f %12.1f %7.0f%%" % (n, n * args.positions, before, after,
+                                                  100 * (before - after) / before)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# Compares the JSON and binary (wire.py) encodings of POS/TELE rows:
+# encode and decode time per message, and payload size.
+#
+import sys
+import time
+import random
+import argparse
+
+import wire
+
+class Properties(object):
+    def __init__(self, content_type):
+        self.content_type = content_type
+
+def sample_rows(n):
+    rows = []
+    msec = 1500000000000
+    for i in xrange(n):
+        msec += random.randint(1, 50)
+        pos = i % 4 == 0
+        params = (msec, random.randint(1, 2000000), random.randint(1, 8) if pos else None,
+                  1, random.randint(0, 200000), random.randint(0, 500000), random.randint(0, 10000000),
+                  random.randint(-20, 500), random.randint(0, 80000000), random.randint(0, 200),
+                  random.randint(1, 5000000), 0, random.choice(['', 'feather', 'draft']),
+                  random.randint(0, 130), random.randint(0, 20))
+        rows.append(('lineid' if pos else 'rad', params))
+    return rows
+
+def bench(rows, format):
+    start = time.time()
+    encoded = [wire.encode_row(location_field, params, format) for location_field, params in rows]
+    encode_time = time.time() - start
+    messages = [(body, Properties(content_type)) for body, content_type in encoded]
+    start = time.time()
+    for body, properties in messages:
+        wire.decode(body, properties)
+    decode_time = time.time() - start
+    size = sum(len(body) for body, properties in messages)
+    return encode_time, decode_time, size
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Wire encoding benchmark')
+    parser.add_argument('-n', '--rows', type=int, default=200000, help='rows to encode')
+    args = parser.parse_args()
+
+    rows = sample_rows(args.rows)
+    print "%-8s %12s %12s %12s" % ('format', 'encode us', 'decode us', 'bytes/msg')
+    for format in wire.FORMATS:
+        encode_time, decode_time, size = bench(rows, format)
+        print "%-8s %12.2f %12.2f %12.1f" % (format, encode_time * 1e6 / len(rows),
+                                             decode_time * 1e6 / len(rows), float(size) / len(rows))
+
+if __name__ == '__main__':
+    main(sys.argv)
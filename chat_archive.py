@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Full-text chat archive.
+#
+# Chat lines are kept in a local SQLite database, in one full-text table per
+# day (chat_YYYYMMDD), using FTS5, or FTS4 where the sqlite library lacks
+# FTS5.  msg and name are indexed; riderid and msec are stored alongside.
+# chat_processor.py feeds the archive (--archive); run this script to search
+# it.  Matches are ranked by bm25 with FTS5, and newest first with FTS4.
+#
+#  Sample usage: ./chat_archive.py chat_archive.sql3 'ride AND on' --rider 12345
+#
+import re
+import sys
+import time
+import sqlite3
+import argparse
+
+import dateutil.parser
+
+DAY_MS = 24 * 3600 * 1000
+ARCHIVE_BATCH_MS = 1000
+
+#
+# Chat lines carry only a HH:MM:SS time.  Returns its msec, taking the date
+# from now (msec), or the day before if the time is more than half a day in
+# the future (the line was logged before midnight).
+#
+def chat_msec(t, now=None):
+    if now is None:
+        now = time.time() * 1000
+    day = time.localtime(now / 1000)
+    h, m, s = t.split(':')
+    msec = int(time.mktime(day[:3] + (int(h), int(m), int(s), 0, 0, -1))) * 1000
+    if msec > now + DAY_MS / 2:
+        msec = int(time.mktime(time.localtime((msec - DAY_MS) / 1000)[:3] +
+                               (int(h), int(m), int(s), 0, 0, -1))) * 1000
+    return msec
+
+def day_table(msec):
+    return 'chat_' + time.strftime('%Y%m%d', time.localtime(msec / 1000))
+
+def fts_module(dbh):
+    try:
+        dbh.execute('create virtual table temp.fts_probe using fts5(x)')
+        dbh.execute('drop table temp.fts_probe')
+        return 'fts5'
+    except sqlite3.OperationalError:
+        return 'fts4'
+
+
+class ChatArchive(object):
+    def __init__(self, path, batch_ms=ARCHIVE_BATCH_MS):
+        self._dbh = sqlite3.connect(path)
+        self._module = fts_module(self._dbh)
+        self._batch_ms = batch_ms
+        self._tables = set(self.tables())
+        self._pending = 0
+        self._due = None
+
+    def tables(self):
+        c = self._dbh.execute("select name from sqlite_master where type = 'table' and name glob 'chat_[0-9]*'")
+        return sorted(r[0] for r in c.fetchall() if re.match(r'^chat_\d{8}$', r[0]))
+
+    def _create(self, table):
+        if self._module == 'fts5':
+            self._dbh.execute('create virtual table if not exists %s using fts5('
+                              'msg, name, riderid unindexed, msec unindexed)' % table)
+        else:
+            self._dbh.execute('create virtual table if not exists %s using fts4('
+                              'msg, name, riderid, msec, notindexed=riderid, notindexed=msec)' % table)
+        self._tables.add(table)
+
+    #
+    # Rows are committed once the oldest uncommitted one is batch_ms old
+    # (see tick), or by flush/close.
+    #
+    def add(self, riderid, name, msg, msec):
+        table = day_table(msec)
+        if table not in self._tables:
+            self._create(table)
+        self._dbh.execute('insert into %s (msg, name, riderid, msec) values (?, ?, ?, ?)' % table,
+                          (msg, name, int(riderid), msec))
+        if not self._pending:
+            self._due = time.time() + self._batch_ms / 1000.0
+        self._pending += 1
+
+    def tick(self):
+        if self._pending and time.time() >= self._due:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._dbh.commit()
+            self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._dbh.close()
+
+    #
+    # Returns up to limit (rank, msec, riderid, name, msg) matches for an
+    # FTS query, best first, from the days between begin_ms and end_ms.
+    #
+    def search(self, query, riderid=None, begin_ms=None, end_ms=None, limit=20):
+        first = day_table(begin_ms) if begin_ms is not None else None
+        last = day_table(end_ms) if end_ms is not None else None
+        where = ' and riderid = ?' if riderid is not None else ''
+        where += ' and msec >= ?' if begin_ms is not None else ''
+        where += ' and msec <= ?' if end_ms is not None else ''
+        params = [query] + [v for v in (riderid, begin_ms, end_ms) if v is not None] + [limit]
+        matches = []
+        for table in self.tables():
+            if (first and table < first) or (last and table > last):
+                continue
+            if self._module == 'fts5':
+                sql = ('select bm25(%s), msec, riderid, name, msg from %s where %s match ?%s '
+                       'order by bm25(%s) limit ?' % (table, table, table, where, table))
+            else:
+                sql = ('select 0, msec, riderid, name, msg from %s where %s match ?%s '
+                       'order by msec desc limit ?' % (table, table, where))
+            matches.extend(self._dbh.execute(sql, params).fetchall())
+        matches.sort(key = lambda m: (m[0], -m[1]))
+        return matches[:limit]
+
+
+def parse_ms(val):
+    return int(time.mktime(dateutil.parser.parse(val).timetuple())) * 1000 if val else None
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Chat Archive Search')
+    parser.add_argument('archive', help='Chat archive (sqlite) written by chat_processor.py --archive')
+    parser.add_argument('query', help='Full-text query (sqlite FTS syntax)')
+    parser.add_argument('-r', '--rider', type=int, help='Only messages from this rider id')
+    parser.add_argument('--since', help='Only messages at or after this date/time')
+    parser.add_argument('--until', help='Only messages at or before this date/time')
+    parser.add_argument('-n', '--limit', type=int, default=20, help='Maximum matches to show')
+    args = parser.parse_args()
+
+    archive = ChatArchive(args.archive)
+    try:
+        for rank, msec, riderid, name, msg in archive.search(args.query, args.rider, parse_ms(args.since),
+                                                             parse_ms(args.until), args.limit):
+            print "%d %s %8d %-16s %s" % (msec, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(msec / 1000)),
+                                          riderid, name.encode('utf-8'), msg.encode('utf-8'))
+    except sqlite3.OperationalError, e:
+        sys.exit('Bad query: %s' % e)
+    finally:
+        archive.close()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se
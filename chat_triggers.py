@@ -0,0 +1,110 @@
+#
+# Chat keyword triggers.
+#
+# A trigger file lists rules, one phrase per line:
+#
+#   # rule    phrase
+#   marshal   stop the race
+#   marshal   neutral zone
+#   abuse     idiot
+#
+# The file is UTF-8; phrases are decoded to unicode, as chat text is.
+# Phrases match whole words, ignoring case.  All phrases are compiled into
+# one Aho-Corasick automaton, so a chat line is scanned once however many
+# phrases there are.  chat_processor.py (--triggers) publishes each match as
+# CHAT_TRIGGER.<rule>.
+#
+import re
+from collections import deque
+
+RULE_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def load_rules(path):
+    rules = []
+    f = open(path, "r")
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        (rule, phrase) = line.split(None, 1)
+        if not RULE_RE.match(rule):
+            raise ValueError('invalid rule name "%s" (routing key part)' % rule)
+        rules.append((rule, phrase.decode('utf-8')))
+    f.close()
+    return rules
+
+
+def word_char(c):
+    return c.isalnum() or c == '_'
+
+#
+# Aho-Corasick automaton over (rule, phrase) pairs.  State 0 is the root;
+# _goto[s] maps a character to the next state, _fail[s] is the longest
+# proper suffix state, and _out[s] the patterns ending at s (including
+# those reached through fail links).
+#
+class TriggerMatcher(object):
+    def __init__(self, rules):
+        self._patterns = []
+        self._goto = [{}]
+        self._out = [[]]
+        for rule, phrase in rules:
+            phrase = ' '.join(phrase.lower().split())
+            if not phrase:
+                continue
+            s = 0
+            for c in phrase:
+                nxt = self._goto[s].get(c)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[s][c] = nxt
+                    self._goto.append({})
+                    self._out.append([])
+                s = nxt
+            self._out[s].append(len(self._patterns))
+            self._patterns.append((rule, phrase))
+
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for c, t in self._goto[s].iteritems():
+                queue.append(t)
+                f = self._fail[s]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[t] = self._goto[f].get(c, 0)
+                self._out[t] = self._out[t] + self._out[self._fail[t]]
+
+    def __len__(self):
+        return len(self._patterns)
+
+    #
+    # Returns the (rule, phrase) pairs found in text, each once, in the
+    # order they end in the text.
+    #
+    def match(self, text):
+        text = ' '.join(text.lower().split())
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        s = 0
+        for i, c in enumerate(text):
+            while s and c not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(c, 0)
+            if out[s]:
+                for p in out[s]:
+                    rule, phrase = self._patterns[p]
+                    start = i - len(phrase) + 1
+                    if (start > 0 and word_char(text[start - 1])) or \
+                            (i + 1 < len(text) and word_char(text[i + 1])):
+                        continue
+                    if (rule, phrase) not in found:
+                        found.append((rule, phrase))
+        return found
+
+
+class ChatTriggers(TriggerMatcher):
+    def __init__(self, path):
+        TriggerMatcher.__init__(self, load_rules(path))
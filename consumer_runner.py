@@ -0,0 +1,161 @@
+#
+# Runs a message handler across several worker processes.
+#
+# The parent process owns the consumer (on any transport.py transport).  Each message is routed to a
+# worker by a hash of one component of its routing key (by default the
+# last, which is the rider id in POS.<line>.<rider>), so messages with the
+# same key are always handled in order by the same worker.
+#
+# Messages are consumed with manual acks, at most prefetch unacknowledged
+# at a time.  Workers report the delivery tags they have finished, and the
+# parent acks the longest run of finished tags with a single multiple=True
+# ack once ack_batch messages (or ack_ms msec) have built up.
+#
+# On SIGINT/SIGTERM consuming stops, the workers finish the messages they
+# already have, those are acked, and the connection is closed.  Anything
+# not acked is redelivered by the broker.
+#
+# make_handler() is called once in each worker, and returns the handler:
+#   handler(routing_key, data)
+# where data is the message decoded by wire.decode().
+#
+import time
+import zlib
+import signal
+import Queue
+import traceback
+import multiprocessing
+
+import wire
+from transport import open_transport
+
+PREFETCH = 1000
+ACK_BATCH = 100
+ACK_MS = 200
+
+
+class Properties(object):
+    def __init__(self, content_type):
+        self.content_type = content_type
+
+
+def worker_main(make_handler, inbox, done, ack_batch):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handler = make_handler()
+    tags = []
+    while True:
+        try:
+            msg = inbox.get(timeout=0.05) if not tags else inbox.get_nowait()
+        except Queue.Empty:
+            if tags:
+                done.put(tags)
+                tags = []
+            continue
+        if msg is None:
+            break
+        tag, routing_key, body, content_type = msg
+        try:
+            handler(routing_key, wire.decode(body, Properties(content_type)))
+        except:
+            print "ERROR - handler for %s: %s" % (routing_key, traceback.format_exc())
+        tags.append(tag)
+        if len(tags) >= ack_batch:
+            done.put(tags)
+            tags = []
+    if tags:
+        done.put(tags)
+    done.put(None)
+
+
+class ConsumerRunner(object):
+    def __init__(self, pika_url, exchange, topics, make_handler, workers=1, queue=None,
+                 prefetch=PREFETCH, ack_batch=ACK_BATCH, ack_ms=ACK_MS, key_index=-1):
+        self._pika_url = pika_url
+        self._exchange = exchange
+        self._topics = topics
+        self._make_handler = make_handler
+        self._nworkers = max(1, workers)
+        self._queue_name = queue
+        self._prefetch = prefetch
+        self._ack_batch = ack_batch
+        self._ack_ms = ack_ms
+        self._key_index = key_index
+        self._stopping = False
+
+    def worker_for(self, routing_key):
+        parts = routing_key.split('.')
+        try:
+            key = parts[self._key_index]
+        except IndexError:
+            key = routing_key
+        return (zlib.crc32(key) & 0xffffffff) % self._nworkers
+
+    def _on_message(self, msg):
+        self._delivered = msg.delivery_tag
+        self._inboxes[self.worker_for(msg.routing_key)].put(
+            (msg.delivery_tag, msg.routing_key, msg.body, msg.content_type))
+
+    #
+    # Collects finished tags from the workers, and acks up to the first
+    # unfinished one if enough have built up (or force is set).
+    #
+    def _ack(self, force=False):
+        while True:
+            try:
+                tags = self._done.get_nowait()
+            except Queue.Empty:
+                break
+            if tags is None:
+                self._finished_workers += 1
+            else:
+                self._completed.update(tags)
+        while self._acked + 1 in self._completed:
+            self._acked += 1
+            self._completed.remove(self._acked)
+        pending = self._acked - self._last_ack
+        if pending and (force or pending >= self._ack_batch or self._acked == self._delivered or
+                        time.time() >= self._ack_due):
+            self._transport.ack(self._acked, multiple=True)
+            self._last_ack = self._acked
+            self._ack_due = time.time() + self._ack_ms / 1000.0
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        self._done = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue() for i in xrange(self._nworkers)]
+        self._workers = [multiprocessing.Process(target=worker_main, name='worker%d' % i,
+                                                 args=(self._make_handler, inbox, self._done, self._ack_batch))
+                         for i, inbox in enumerate(self._inboxes)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+        self._completed = set()
+        self._delivered = self._acked = self._last_ack = 0
+        self._finished_workers = 0
+        self._ack_due = time.time() + self._ack_ms / 1000.0
+
+        self._transport = open_transport(self._pika_url)
+        self._transport.subscribe([(self._exchange, t) for t in self._topics], self._on_message, no_ack=False,
+                                  prefetch=self._prefetch, queue=self._queue_name)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        try:
+            while not self._stopping:
+                self._transport.process(0.05)
+                self._ack()
+        except KeyboardInterrupt:
+            pass
+
+        print "Stopping consumer, waiting for %d workers" % self._nworkers
+        self._transport.cancel()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        while self._finished_workers < self._nworkers and any(w.is_alive() for w in self._workers):
+            self._transport.process(0.05)
+            self._ack()
+        self._ack(force=True)
+        self._transport.close()
+        for w in self._workers:
+            w.join()
@@ -154,7 +154,7 @@ def get_rider_list():
     mkresults.dbh = sqlite3.connect('race_database.sql3')
     conf = mkresults.config(args.config)
     mkresults.conf = conf
-    mkresults.args = namedtuple('Args', 'no_cat debug')(no_cat=False, debug=args.verbose)
+    mkresults.args = namedtuple('Args', 'no_cat debug columnar')(no_cat=False, debug=args.verbose, columnar=False)
 
     startTime = conf.start_ms / 1000
     retrievalTime = startTime + conf.start_window_ms / 1000
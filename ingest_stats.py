@@ -0,0 +1,161 @@
+#
+# Ingest metrics: counters, gauges and latency histograms, shared by all
+# threads of a process through the module level stats object.
+#
+# The current values can be published by a StatsReporter, which rewrites
+# a JSON stats file every interval and/or serves the same JSON over HTTP.
+#
+import os
+import time
+import json
+import threading
+import traceback
+import BaseHTTPServer
+
+# histogram bucket upper bounds, in msec.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def data(self):
+        buckets = []
+        total = 0
+        for le, n in zip(BUCKETS_MS + ('+Inf',), self.counts):
+            total += n
+            buckets.append([le, total])
+        return {'count': self.count, 'sum_ms': round(self.sum, 3), 'max_ms': round(self.max, 3),
+                'avg_ms': round(self.sum / self.count, 3) if self.count else 0,
+                'buckets': buckets}
+
+
+class IngestStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._values = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._rates = {}
+        self._rate_time = time.time()
+        self._rate_counters = {}
+        self.started = time.time()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self._values[name] = value
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    # fn() is evaluated each time a snapshot is taken.
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def observe(self, name, ms):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].observe(ms)
+
+    #
+    # Recompute the per second rate of every counter over the time since
+    # the previous call.
+    #
+    def update_rates(self):
+        now = time.time()
+        with self._lock:
+            counters = dict(self._counters)
+        elapsed = max(now - self._rate_time, 0.001)
+        self._rates = dict((k, round((v - self._rate_counters.get(k, 0)) / elapsed, 1))
+                           for k, v in counters.items())
+        self._rate_counters = counters
+        self._rate_time = now
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((k, h.data()) for k, h in self._histograms.items())
+        gauges = dict(self._values)
+        for name, fn in self._gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        return {'time': time.time(), 'uptime': round(time.time() - self.started, 1),
+                'counters': counters, 'rates': self._rates, 'gauges': gauges,
+                'histograms': histograms}
+
+
+stats = IngestStats()
+
+
+class _StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(stats.snapshot(), indent=1, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+#
+# Every interval seconds, updates the counter rates and rewrites the stats
+# file (if any).  If port is set, the stats are also served as JSON on
+# http://127.0.0.1:port/.  stop() writes the file one last time, so the
+# final snapshot holds everything counted up to the end of the run.
+#
+class StatsReporter(threading.Thread):
+    def __init__(self, interval, path=None, port=None):
+        threading.Thread.__init__(self, name='stats')
+        self.daemon = True
+        self._interval = interval
+        self._path = path
+        self._stop = threading.Event()
+        self._server = None
+        if port:
+            self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _StatsHandler)
+            t = threading.Thread(target=self._server.serve_forever, name='stats-http')
+            t.daemon = True
+            t.start()
+
+    def write(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(stats.snapshot(), f, indent=1, sort_keys=True)
+        os.rename(tmp, self._path)
+
+    def run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self._interval)
+            stats.update_rates()
+            if self._path:
+                try:
+                    self.write()
+                except:
+                    print "WARNING - could not write stats file: %s" % traceback.format_exc()
+
+    def stop(self):
+        self._stop.set()
+        self.join(5)
@@ -0,0 +1,207 @@
+#
+# Follow a growing log file, yielding each complete line as soon as it
+# has been written.
+#
+# The file is read in large chunks straight from the descriptor, and each
+# chunk is split into lines in one pass.  At end of file the follower waits
+# for the writer: via inotify on Linux, kqueue on BSD/Mac, and by polling
+# everywhere else.  If the file is truncated, or replaced by a new file
+# (log rotation), the follower starts again at the beginning of the file
+# now at the path.
+#
+import os
+import sys
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+CHUNK_SIZE = 256 * 1024
+
+# polling interval when no change notification mechanism is available.
+POLL_INTERVAL = 0.05
+
+# even with notifications, re-check the file this often.
+MAX_WAIT = 1.0
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVE_SELF    = 0x00000800
+IN_DELETE_SELF  = 0x00000400
+IN_NONBLOCK     = 0x00000800
+IN_CLOEXEC      = 0x00080000
+
+
+class InotifyWatcher(object):
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+        if libc.inotify_add_watch(self._fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, 'inotify_add_watch failed for %s' % path)
+
+    # Returns True if the file may have changed.
+    def wait(self, timeout):
+        r, _, _ = select.select([self._fd], [], [], timeout)
+        if not r:
+            return False
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+class KqueueWatcher(object):
+    def __init__(self, fd):
+        self._kq = select.kqueue()
+        flags = select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_ATTRIB | \
+                select.KQ_NOTE_RENAME | select.KQ_NOTE_DELETE
+        self._ev = select.kevent(fd, filter=select.KQ_FILTER_VNODE,
+                                 flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR, fflags=flags)
+        self._kq.control([self._ev], 0, 0)
+
+    def wait(self, timeout):
+        return bool(self._kq.control(None, 1, timeout))
+
+    def close(self):
+        self._kq.close()
+
+
+class PollWatcher(object):
+    def wait(self, timeout):
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return True
+
+    def close(self):
+        pass
+
+
+def make_watcher(path, fd):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    if hasattr(select, 'kqueue'):
+        try:
+            return KqueueWatcher(fd)
+        except (OSError, select.error):
+            pass
+    return PollWatcher()
+
+
+#
+# Iterating a LogFollower yields complete lines, without the trailing
+# newline.  A partial line is held back until its newline arrives.
+#
+# If idle_timeout is set, None is yielded each time end of file is reached
+# and then again every idle_timeout seconds while no new data arrives, so
+# the caller can do periodic work.
+#
+# With follow=False, iteration stops at end of file instead.
+#
+# inode and offset identify the file, and the position just past the last
+# yielded line.
+#
+class LogFollower(object):
+    def __init__(self, path, offset=0, idle_timeout=None, chunk_size=CHUNK_SIZE, follow=True):
+        self.path = path
+        self.follow = follow
+        self._idle_timeout = idle_timeout
+        self._chunk_size = chunk_size
+        self._watcher = None
+        self._open(offset)
+
+    def _open(self, offset):
+        self._fd = os.open(self.path, os.O_RDONLY)
+        self.inode = os.fstat(self._fd).st_ino
+        self.offset = offset
+        self._partial = ''
+        if offset:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+        if self.follow:
+            self._watcher = make_watcher(self.path, self._fd)
+
+    def __iter__(self):
+        return self.lines()
+
+    def _read(self):
+        return os.read(self._fd, self._chunk_size)
+
+    #
+    # Called at end of file.  Returns True if reading should restart from
+    # the beginning of a truncated or replaced file.
+    #
+    def _reset(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False                # rotated, new file not created yet.
+        if st.st_ino != self.inode:
+            print "%s: file replaced, following new file" % self.path
+            self.close()
+            self._open(0)
+            return True
+        if st.st_size < os.lseek(self._fd, 0, os.SEEK_CUR):
+            print "%s: file truncated, restarting at beginning" % self.path
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            self.offset = 0
+            self._partial = ''
+            return True
+        return False
+
+    def lines(self):
+        while True:
+            chunk = self._read()
+            if not chunk:
+                if not self.follow:
+                    return
+                if self._reset():
+                    continue
+                if self._idle_timeout is None:
+                    self._watcher.wait(MAX_WAIT)
+                    continue
+                yield None
+                self._watcher.wait(self._idle_timeout)
+                continue
+
+            lines = chunk.split('\n')
+            if self._partial:
+                lines[0] = self._partial + lines[0]
+            self._partial = lines.pop()
+            for line in lines:
+                self.offset += len(line) + 1
+                yield line
+
+    def close(self):
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+        os.close(self._fd)
+
+
+#
+# Read complete lines from a closed file, from start up to end.
+#   end must be at a line boundary.
+#
+def read_lines(path, start=0, end=None):
+    f = LogFollower(path, offset=start, follow=False)
+    try:
+        for line in f:
+            if end is not None and f.offset > end:
+                break
+            yield line
+    finally:
+        f.close()
@@ -7,9 +7,25 @@ import re
 
 import dateutil.parser
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 RICHMOND_LAP = 16 * 1000                # 1 lap of richmond = 16.09km
 
-class rider():
+#
+# One rider's positions and results.  Riders and positions are slotted:
+# a large window holds millions of pos records, and a per-instance
+# __dict__ costs more than the data it holds.
+#
+class rider(object):
+    __slots__ = ('id', 'pos', 'fname', 'lname', 'cat', 'weight', 'height', 'age', 'male',
+                 '_power', 'power', 'name', 'has_info', 'strava_id', 'team',
+                 'finish', 'end_time', 'dq_time', 'dq_reason', 'distance', 'points', 'end',
+                 'grp', 'dnf', 'dq', 'place', 'timepos',
+                 'mwh', 'meters', 'msec', 'watts', 'wkg', 'ecat')
+
     def __init__(self, id):
         self.id         = id
         self.pos        = []
@@ -236,7 +252,10 @@ def summarize_ride(r):
 #
 # Observed position record, keyed by observation time.
 #
-class pos():
+class pos(object):
+    __slots__ = ('time_ms', 'line_id', 'forward', 'meters', 'mwh', 'duration',
+                 'elevation', 'speed', 'hr')
+
     def __init__(self, v):
         self.time_ms    = v[0]
         self.line_id    = int(v[1])
@@ -290,6 +309,177 @@ def get_riders(begin_ms, end_ms):
     return R, all_pos
 
 
+#
+# Columnar position store (--columnar).
+#
+# get_riders_columnar() keeps each rider's crossings as a slice of one numpy
+# structured array, in POS_DTYPE, instead of a list of pos objects.  The
+# start/course/crash/finish rules run on the arrays (see the *_columnar
+# functions); everything else sees r.pos as a pos_array, which builds pos
+# objects only for the records actually looked at.
+#
+POS_DTYPE = [('time_ms', 'i8'), ('line_id', 'i4'), ('forward', 'i1'), ('meters', 'f8'),
+             ('mwh', 'f8'), ('duration', 'f8'), ('elevation', 'f8'), ('speed', 'f8'), ('hr', 'f8')]
+
+def make_pos(v):
+    return pos((int(v[0]),) + tuple(v)[1:])
+
+class pos_array():
+    def __init__(self, a):
+        self.a = a
+
+    def __len__(self):
+        return len(self.a)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return pos_array(self.a[k])
+        return make_pos(self.a[k])
+
+    def __iter__(self):
+        for v in self.a:
+            yield make_pos(v)
+
+    def index(self, p):
+        i = numpy.nonzero((self.a['time_ms'] == p.time_ms) & (self.a['line_id'] == p.line_id))[0]
+        if not len(i):
+            raise ValueError('position not in list')
+        return int(i[0])
+
+#
+# all_pos for the columnar store: (pos, rider) in time order, built as
+#  they are iterated.
+#
+class columnar_all_pos():
+    def __init__(self, R, ids, a):
+        self.R = R
+        self.ids = ids
+        self.a = a
+
+    def __iter__(self):
+        for id, v in zip(self.ids, self.a):
+            yield make_pos(v), self.R[int(id)]
+
+def get_riders_columnar(begin_ms, end_ms):
+    if numpy is None:
+        sys.exit('--columnar needs numpy')
+    c = dbh.cursor()
+    if hasattr(dbh, '__module__') and dbh.__module__.startswith('mysql'):
+        query = '''select riderid, msec, lineid, fwd,
+            meters, mwh, duration, elevation, speed, hr from live_results
+            where msec between %s and %s and backupwatcher is null order by msec asc'''
+    else:
+        query = '''select rider_id, time_ms, line_id, forward,
+            meters, mwh, duration, elevation, speed, hr from pos
+            where time_ms between ? and ? order by time_ms asc'''
+    c.execute(query, (begin_ms, end_ms))
+    rows = numpy.array([tuple(v) for v in c.fetchall()], dtype=[('rider_id', 'i8')] + POS_DTYPE)
+    ids = rows['rider_id']
+    a = numpy.empty(len(rows), dtype=POS_DTYPE)
+    for name, t in POS_DTYPE:
+        a[name] = rows[name]
+
+    # stable sort by rider keeps each rider's crossings in time order.
+    order = numpy.argsort(ids, kind='mergesort')
+    by_rider = a[order]
+    rider_ids, first = numpy.unique(ids[order], return_index=True)
+    R = {}
+    for i, id in enumerate(rider_ids):
+        last = first[i + 1] if i + 1 < len(first) else len(by_rider)
+        r = rider(int(id))
+        r.pos = pos_array(by_rider[first[i]:last])
+        R[r.id] = r
+    return R, columnar_all_pos(R, ids, a)
+
+
+#
+# Streaming pipeline (--stream).
+#
+# read_riders() reads the window ordered by (rider, time) and yields each
+# rider as soon as their rows are complete.  stream_riders() takes each one
+# through the start, course, crash and finish rules straight away, then
+# keeps only the first and last positions (--split keeps them all), so
+# memory follows the largest ride rather than the window.  Group lead
+# riders are read first: every finish needs their start time.
+#
+STREAM_ROWS = 10000
+
+def read_riders(begin_ms, end_ms, rider_id=None):
+    c = dbh.cursor()
+    if hasattr(dbh, '__module__') and dbh.__module__.startswith('mysql'):
+        query = '''select riderid, msec, lineid, fwd,
+            meters, mwh, duration, elevation, speed, hr from live_results
+            where msec between %s and %s and backupwatcher is null'''
+        query += ' and riderid = %s' if rider_id is not None else ''
+        query += ' order by riderid asc, msec asc'
+    else:
+        query = '''select rider_id, time_ms, line_id, forward,
+            meters, mwh, duration, elevation, speed, hr from pos
+            where time_ms between ? and ?'''
+        query += ' and rider_id = ?' if rider_id is not None else ''
+        query += ' order by rider_id asc, time_ms asc'
+    c.execute(query, (begin_ms, end_ms) + ((rider_id,) if rider_id is not None else ()))
+    id = None
+    rows = []
+    while True:
+        data = c.fetchmany(STREAM_ROWS)
+        if not data:
+            break
+        for v in data:
+            if v[0] != id:
+                if rows:
+                    yield make_rider(id, rows)
+                id = v[0]
+                rows = []
+            rows.append(v[1:])
+    if rows:
+        yield make_rider(id, rows)
+    c.close()
+
+def make_rider(id, rows):
+    r = rider(id)
+    if args.columnar:
+        r.pos = pos_array(numpy.array([tuple(v) for v in rows], dtype=POS_DTYPE))
+    else:
+        r.pos = [pos(v) for v in rows]
+    return r
+
+#
+# Returns the started riders, trimmed, with their finish records and
+#  summary positions.
+#
+def stream_riders(begin_ms, end_ms):
+    if args.columnar and numpy is None:
+        sys.exit('--columnar needs numpy')
+    leads = {}
+    for grp in conf.grp:
+        if (grp.lead is not None) and (grp.lead not in leads):
+            for r in read_riders(begin_ms, end_ms, grp.lead):
+                leads[r.id] = (r, filter_start(r))
+    for grp in conf.grp:
+        grp_start(grp, dict((id, v[0]) for id, v in leads.items()))
+
+    F = []
+    count = 0
+    for r in read_riders(begin_ms, end_ms):
+        count += 1
+        if r.id in leads:
+            r, started = leads[r.id]
+        else:
+            started = filter_start(r)
+        if not started:
+            continue
+        trim_course(r)
+        trim_crash(r)
+        [ grp_finish(r, grp) for grp in conf.grp ]
+        if not args.split:
+            r.pos = [r.pos[0], r.pos[-1]] if len(r.pos) > 1 else [r.pos[0]]
+        F.append(r)
+    if (args.debug):
+        print 'Streamed %d riders, %d started' % (count, len(F))
+    return F
+
+
 #
 # Maps the chalkline name into a line_id.
 #
@@ -705,6 +895,8 @@ def filter_tag(r, tag):
 #   (may be larger for longer, delaeyed neutrals.
 #
 def filter_start(r):
+    if args.columnar:
+        return filter_start_columnar(r)
     start = None
     for idx, p in enumerate(r.pos):
 
@@ -774,6 +966,8 @@ def filter_start(r):
 #  distance and correct finish is validated later.
 #
 def trim_course(r):
+    if args.columnar:
+        return trim_course_columnar(r)
     forward = conf.start_forward
     for idx, p in enumerate(r.pos[1:]):
         if not (p.line_id == conf.finish_line_id):
@@ -795,6 +989,8 @@ def trim_course(r):
 # Trims position records and sets maximum distance.
 #
 def trim_crash(r):
+    if args.columnar:
+        return trim_crash_columnar(r)
     s = r.pos[0]
     l = s
     r.distance = 0
@@ -820,11 +1016,113 @@ def trim_crash(r):
     return True
 
 
+#
+# filter_start, trim_course, trim_crash and the grp_finish search on the
+# columnar store.  Same rules, same results.
+#
+def filter_start_columnar(r):
+    a = r.pos.a
+    window = numpy.searchsorted(a['time_ms'], conf.start_ms + conf.start_window_ms, side='right')
+    crossings = numpy.nonzero((a['line_id'][:window] == conf.start_line_id) &
+                              ((a['forward'][:window] == 1) == conf.start_forward))[0]
+    if not len(crossings):
+        return False
+
+    # last valid crossing: each later one replaces it if it is before the
+    #  start or less than 3000 meters on.
+    start = crossings[0]
+    for idx in crossings[1:]:
+        if (a['time_ms'][idx] < conf.start_ms) or \
+                ((a['meters'][idx] - a['meters'][start]) < 3000):
+            start = idx
+
+    s = r.pos[start]
+    if conf.corral_line and \
+            (s.time_ms < (conf.start_ms + (20 * MSEC_PER_SEC))):
+        corral = numpy.nonzero(a['line_id'][:start + 1] == conf.corral_line_id)[0]
+        if len(corral):
+            p = r.pos[corral[-1]]
+            pace = avg_pace(p, s)
+            if (pace > 18):
+                r.set_dq(p.time_ms, 'Corral: %2d km/h' % (pace))
+
+    r.pos = r.pos[start:]
+    if (args.debug):
+        print 'START', r.id, r.pos[0]
+    return True
+
+
+def trim_course_columnar(r):
+    if conf.alternate is None:
+        return True
+    a = r.pos.a
+    idx = numpy.nonzero(a['line_id'][1:] == conf.finish_line_id)[0] + 1
+    # crossing k (from 0) should be the opposite of the start direction
+    #  for even k, the same for odd k.
+    expected = (numpy.arange(len(idx)) % 2 == 1) == conf.start_forward
+    wrong = numpy.nonzero((a['forward'][idx] == 1) != expected)[0]
+    if len(wrong):
+        i = idx[wrong[0]]
+        if (args.debug):
+            print 'WRONG', r.id, r.pos[i]
+        r.set_dq(int(a['time_ms'][i]), "WRONG COURSE")
+        r.pos = r.pos[:i]
+    return True
+
+
+def trim_crash_columnar(r):
+    a = r.pos.a
+    s = a[0]
+    rest = a[1:]
+    r.distance = 0
+    meters_crash = rest['meters'] < s['meters']
+    crash = numpy.nonzero(meters_crash | (rest['mwh'] < s['mwh']) |
+                          (rest['duration'] < s['duration']))[0]
+    if not len(crash):
+        if len(rest):
+            r.distance = float(rest['meters'][-1] - s['meters'])
+        return True
+
+    i = crash[0]
+    if meters_crash[i]:
+        if i:
+            r.distance = float(rest['meters'][i - 1] - s['meters'])
+        r.distance = max(r.distance, float(rest['meters'][i]))
+    else:
+        r.distance = float(rest['meters'][i] - s['meters'])
+    r.set_dq(int(rest['time_ms'][i]), "----CRASHED---")
+    r.pos = r.pos[:i + 1]
+    return True
+
+
+def finish_columnar(r, grp):
+    a = r.pos.a
+    idx = numpy.nonzero(((a['meters'][1:] - a['meters'][0]) >= grp.distance) &
+                        (a['line_id'][1:] == conf.finish_line_id) &
+                        ((a['forward'][1:] == 1) == conf.finish_forward))[0]
+    return r.pos[idx[0] + 1] if len(idx) else None
+
+
+#
+# Group start: the lead rider's start, or the configured delay.
+#
+def grp_start(grp, R):
+    if (grp.lead is not None) and (grp.lead in R):
+        grp.starter = R[grp.lead]
+        grp.start_ms = grp.starter.pos[0].time_ms
+    elif grp.delay_ms is not None:
+        grp.start_ms = conf.start_ms + grp.delay_ms
+    else:
+        grp.start_ms = conf.start_ms
+
+
 #
 # Better off just to have a set of results for each class.
 # then results just pick the "ASSIGNED" class, or the best weighted one.
 #
-class grp_finish():
+class grp_finish(object):
+    __slots__ = ('grp', 'pos', 'dq_time', 'dq_reason')
+
     def __init__(self, r, grp):
         self.grp        = grp
         self.pos        = None
@@ -833,13 +1131,16 @@ class grp_finish():
 
         r.finish.append(self)
 
-        s = r.pos[0]
-        for idx, p in enumerate(r.pos[1:]):
-            if ((p.meters - s.meters) >= grp.distance) and \
-                    (p.line_id == conf.finish_line_id) and \
-                    (p.forward == conf.finish_forward):
-                self.pos = p
-                break
+        if args.columnar:
+            self.pos = finish_columnar(r, grp)
+        else:
+            s = r.pos[0]
+            for idx, p in enumerate(r.pos[1:]):
+                if ((p.meters - s.meters) >= grp.distance) and \
+                        (p.line_id == conf.finish_line_id) and \
+                        (p.forward == conf.finish_forward):
+                    self.pos = p
+                    break
 
         # if no end position, this is a DNF. (or crash)
         if self.pos is None:
@@ -1454,6 +1755,10 @@ def main(argv):
     parser.add_argument('-N', '--race_name', help='race name')
     parser.add_argument('-W', '--profile_window', help='Window (in seconds from start) for profile retrieval',
                         default=7200, type=int)
+    parser.add_argument('--columnar', action='store_true',
+            help='Keep positions in numpy arrays (less memory and faster for large windows)')
+    parser.add_argument('--stream', action='store_true',
+            help='Process riders as they are read, keeping only their summary (long events)')
     parser.add_argument('config_file', help='Configuration file for race.')
     args = parser.parse_args()
 
@@ -1500,20 +1805,31 @@ def main(argv):
                 time.ctime(conf.finish_ms / 1000)))
         print('time: [%d .. %d]' % (conf.start_ms, conf.finish_ms))
 
-    R, all_pos = get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
-    if (args.debug):
-        print 'Selected %d riders' % len(R)
+    if args.stream:
+        #
+        # POINTS needs every rider's crossings in time order.
+        #
+        if conf.points:
+            sys.exit('--stream cannot be used with POINTS')
+        F = stream_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+    else:
+        if args.columnar:
+            R, all_pos = get_riders_columnar(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+        else:
+            R, all_pos = get_riders(conf.start_ms - conf.lookback_ms, conf.finish_ms)
+        if (args.debug):
+            print 'Selected %d riders' % len(R)
 
-    #
-    # Cut rider list down to only those who crossed the start line
-    # in the correct direction from the time the race started.
-    #
-    if args.debug:
-        print "filtering start line id %s dir %s" % (conf.start_line_id, conf.start_forward)
-    F = R.values()
-    F = [ r for r in F if filter_start(r) ]
-    if (args.debug):
-        print 'Filtered to %d riders' % len(F)
+        #
+        # Cut rider list down to only those who crossed the start line
+        # in the correct direction from the time the race started.
+        #
+        if args.debug:
+            print "filtering start line id %s dir %s" % (conf.start_line_id, conf.start_forward)
+        F = R.values()
+        F = [ r for r in F if filter_start(r) ]
+        if (args.debug):
+            print 'Filtered to %d riders' % len(F)
 
     # pull names from the database.
     if hasattr(dbh, '__module__') and dbh.__module__.startswith('mysql'):
@@ -1544,26 +1860,21 @@ def main(argv):
         F = [r for r in F if filter_tag(r, conf.required_tag) ]
 
     #
-    # Trim position records.
+    # Trim position records.  (done as they are read when streaming)
     #
-    [ trim_course(r) for r in F ]
-    [ trim_crash(r) for r in F ]
+    if not args.stream:
+        [ trim_course(r) for r in F ]
+        [ trim_crash(r) for r in F ]
 
     #
     # Create cat result records.  Riders have records for every cat group.
     #   If the rider's cat is known, the correct record is used.
     #   When autodetecting cat, the highest weighted finish record is used.
     #
-    for grp in conf.grp:
-        if (grp.lead is not None) and (grp.lead in R):
-            grp.starter = R[grp.lead]
-            grp.start_ms = grp.starter.pos[0].time_ms
-        elif grp.delay_ms is not None:
-            grp.start_ms = conf.start_ms + grp.delay_ms
-        else:
-            grp.start_ms = conf.start_ms
-
-        [ grp_finish(r, grp) for r in F ]
+    if not args.stream:
+        for grp in conf.grp:
+            grp_start(grp, R)
+            [ grp_finish(r, grp) for r in F ]
 
     #
     # Set rider cat here, in order to select the correct finish record.
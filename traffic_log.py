@@ -0,0 +1,145 @@
+#
+# Recorded exchange traffic (subscribe_events.py --record / --replay).
+#
+# A recording is a directory of segment files, each named for the msec of
+# its first message and covering segment_ms of traffic.  A segment is a
+# sequence of zlib compressed blocks of about a second of messages:
+#
+#   BLOCK    magic, first msec, last msec, message count, compressed length,
+#            followed by the compressed messages
+#   MESSAGE  msec, exchange length, routing key length, content type length,
+#            body length, followed by exchange, routing key, content type, body
+#
+# The block headers are the time index: reading a window only opens the
+# segments that overlap it, and skips blocks outside it without
+# decompressing them.
+#
+import os
+import re
+import zlib
+import struct
+
+BLOCK_MAGIC = 'ZLRB'
+BLOCK_STRUCT = struct.Struct('<4sqqII')
+MESSAGE_STRUCT = struct.Struct('<qBHBI')
+
+SEGMENT_MS = 5 * 60 * 1000
+BLOCK_MS = 1000
+BLOCK_BYTES = 1 << 20
+COMPRESS_LEVEL = 1
+
+SEGMENT_RE = re.compile(r'^(\d{13})\.zlr$')
+
+
+class TrafficWriter(object):
+    def __init__(self, path, segment_ms=SEGMENT_MS, block_ms=BLOCK_MS):
+        self._path = path
+        self._segment_ms = segment_ms
+        self._block_ms = block_ms
+        self._f = None
+        self._segment_start = None
+        self._block = []
+        self._block_bytes = 0
+        self._first = self._last = None
+        self.messages = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def add(self, msec, exchange, routing_key, content_type, body):
+        exchange, routing_key, content_type = [v.encode('utf-8') if isinstance(v, unicode) else v
+                                               for v in (exchange, routing_key, content_type or '')]
+        if not self._block:
+            self._first = msec
+        self._last = msec
+        record = MESSAGE_STRUCT.pack(msec, len(exchange), len(routing_key), len(content_type),
+                                     len(body)) + exchange + routing_key + content_type + body
+        self._block.append(record)
+        self._block_bytes += len(record)
+        self.messages += 1
+        if self._block_bytes >= BLOCK_BYTES or msec - self._first >= self._block_ms:
+            self.flush()
+
+    # Writes a partial block once it is block_ms old.
+    def tick(self, msec):
+        if self._block and msec - self._first >= self._block_ms:
+            self.flush()
+
+    def flush(self):
+        if not self._block:
+            return
+        if self._f is None or self._first - self._segment_start >= self._segment_ms:
+            if self._f:
+                self._f.close()
+            self._segment_start = self._first
+            self._f = open(os.path.join(self._path, '%013d.zlr' % self._first), 'ab')
+        data = zlib.compress(''.join(self._block), COMPRESS_LEVEL)
+        self._f.write(BLOCK_STRUCT.pack(BLOCK_MAGIC, self._first, self._last, len(self._block), len(data)))
+        self._f.write(data)
+        self._f.flush()
+        self._block = []
+        self._block_bytes = 0
+
+    def close(self):
+        self.flush()
+        if self._f:
+            self._f.close()
+
+
+class TrafficReader(object):
+    def __init__(self, path):
+        self._path = path
+
+    def segments(self):
+        return sorted((int(m.group(1)), os.path.join(self._path, name))
+                      for name, m in ((n, SEGMENT_RE.match(n)) for n in os.listdir(self._path)) if m)
+
+    #
+    # Yields (msec, exchange, routing_key, content_type, body) for the
+    # messages recorded between begin_ms and end_ms, in recorded order.
+    #
+    def read(self, begin_ms=None, end_ms=None):
+        segments = self.segments()
+        for i, (start, path) in enumerate(segments):
+            if end_ms is not None and start > end_ms:
+                break
+            if begin_ms is not None and i + 1 < len(segments) and segments[i + 1][0] <= begin_ms:
+                continue
+            for msg in self._read_segment(path, begin_ms, end_ms):
+                yield msg
+
+    def _read_segment(self, path, begin_ms, end_ms):
+        f = open(path, 'rb')
+        try:
+            while True:
+                header = f.read(BLOCK_STRUCT.size)
+                if len(header) < BLOCK_STRUCT.size:
+                    break
+                magic, first, last, count, length = BLOCK_STRUCT.unpack(header)
+                if magic != BLOCK_MAGIC:
+                    raise ValueError('%s: bad block at offset %d' % (path, f.tell() - len(header)))
+                if (end_ms is not None and first > end_ms):
+                    break
+                if (begin_ms is not None and last < begin_ms):
+                    f.seek(length, os.SEEK_CUR)
+                    continue
+                data = f.read(length)
+                if len(data) < length:
+                    break                       # truncated by a crash while recording
+                data = zlib.decompress(data)
+                offset = 0
+                for n in xrange(count):
+                    msec, le, lk, lc, lb = MESSAGE_STRUCT.unpack_from(data, offset)
+                    offset += MESSAGE_STRUCT.size
+                    exchange = data[offset:offset + le]
+                    offset += le
+                    routing_key = data[offset:offset + lk]
+                    offset += lk
+                    content_type = data[offset:offset + lc] or None
+                    offset += lc
+                    body = data[offset:offset + lb]
+                    offset += lb
+                    if (begin_ms is not None and msec < begin_ms) or (end_ms is not None and msec > end_ms):
+                        continue
+                    yield msec, exchange, routing_key, content_type, body
+        finally:
+            f.close()
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+#
+# Message transport for the zlogger scripts.
+#
+# open_transport(url) returns the backend for url:
+#
+#   amqp://...            RabbitMQ, through pika
+#   local:///path/socket  the local bus: a broker process listening on a unix
+#                         domain socket (run ./transport.py /path/socket)
+#
+# Both backends have the same topic semantics: messages are published to an
+# exchange with a routing key, and subscriptions bind exchange/pattern
+# pairs, where '*' in a pattern matches one word of the key and '#' zero or
+# more.  Every transport has:
+#
+#   publisher()            an asynchronous publisher for producers, with
+#                          publish(exchange, key, body, content_type=None)
+#                          and close()
+#   publish(...)           a synchronous publish on the transport connection
+#   subscribe(bindings, callback, no_ack=True, prefetch=None, queue=None)
+#                          callback(msg) gets a Message for each delivery
+#   process(time_limit)    delivers messages for up to time_limit seconds
+#   ack(tag, multiple=False), cancel(), sleep(seconds), close()
+#
+# The local bus keeps no messages on disk, and its queues last as long as
+# the subscriber's connection (like an exclusive AMQP queue).  With no_ack
+# off, at most prefetch messages are delivered ahead of the acks.
+#
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+import argparse
+import threading
+from collections import deque
+
+FRAME_STRUCT = struct.Struct('<BI')
+MESSAGE_STRUCT = struct.Struct('<BHBI')
+BIND_STRUCT = struct.Struct('<IBB')
+TAG_STRUCT = struct.Struct('<Q')
+ACK_STRUCT = struct.Struct('<QB')
+
+FRAME_BIND = 1
+FRAME_PUBLISH = 2
+FRAME_DELIVER = 3
+FRAME_ACK = 4
+FRAME_CANCEL = 5
+
+MAX_QUEUE = 1000000
+MAX_OUT = 1000
+RECONNECT_SECONDS = 3
+MAX_BUFFER = 100000
+
+
+class Message(object):
+    def __init__(self, exchange, routing_key, content_type, body, delivery_tag=None):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.content_type = content_type
+        self.body = body
+        self.delivery_tag = delivery_tag
+
+
+def open_transport(url):
+    if url.startswith('local://'):
+        return LocalTransport(url[len('local://'):])
+    return PikaTransport(url)
+
+#
+# AMQP topic matching: '*' is exactly one word, '#' zero or more.
+#
+def topic_match(pattern, key):
+    return _match(pattern.split('.'), key.split('.'))
+
+def _match(p, k):
+    if not p:
+        return not k
+    if p[0] == '#':
+        return any(_match(p[1:], k[i:]) for i in xrange(len(k) + 1))
+    if not k:
+        return False
+    return (p[0] == '*' or p[0] == k[0]) and _match(p[1:], k[1:])
+
+
+def utf8(v):
+    return v.encode('utf-8') if isinstance(v, unicode) else v
+
+def pack_message(exchange, routing_key, content_type, body):
+    exchange, routing_key, content_type, body = [utf8(v) for v in (exchange, routing_key, content_type or '', body)]
+    return MESSAGE_STRUCT.pack(len(exchange), len(routing_key), len(content_type),
+                               len(body)) + exchange + routing_key + content_type + body
+
+def unpack_message(data, offset=0):
+    le, lk, lc, lb = MESSAGE_STRUCT.unpack_from(data, offset)
+    offset += MESSAGE_STRUCT.size
+    exchange = data[offset:offset + le]
+    offset += le
+    routing_key = data[offset:offset + lk]
+    offset += lk
+    content_type = data[offset:offset + lc] or None
+    offset += lc
+    return exchange, routing_key, content_type, data[offset:offset + lb]
+
+def frame(kind, payload=''):
+    return FRAME_STRUCT.pack(kind, len(payload)) + payload
+
+#
+# Splits buffered bytes into (kind, payload) frames; returns the frames and
+# the unparsed remainder.
+#
+def read_frames(buf):
+    frames = []
+    offset = 0
+    while len(buf) - offset >= FRAME_STRUCT.size:
+        kind, length = FRAME_STRUCT.unpack_from(buf, offset)
+        end = offset + FRAME_STRUCT.size + length
+        if end > len(buf):
+            break
+        frames.append((kind, buf[offset + FRAME_STRUCT.size:end]))
+        offset = end
+    return frames, buf[offset:]
+
+
+class PikaPublisher(object):
+    def __init__(self, url, max_buffer):
+        import pika
+        from amqp_publisher import AmqpPublisher
+        self._pika = pika
+        self._publisher = AmqpPublisher(url, max_buffer=max_buffer)
+        self._publisher.start()
+        self._properties = {}
+
+    def publish(self, exchange, routing_key, body, content_type=None):
+        properties = None
+        if content_type:
+            properties = self._properties.get(content_type)
+            if properties is None:
+                properties = self._properties[content_type] = self._pika.BasicProperties(content_type=content_type)
+        self._publisher.publish(exchange, routing_key, body, properties)
+
+    def buffered(self):
+        return self._publisher.buffered()
+
+    def close(self):
+        self._publisher.close()
+
+
+class PikaTransport(object):
+    def __init__(self, url):
+        import pika
+        self._pika = pika
+        self._url = url
+        self._connection = None
+        self._channel = None
+        self._consumer_tag = None
+        self._properties = {}
+
+    def _open(self):
+        if self._connection is None:
+            self._connection = self._pika.BlockingConnection(self._pika.URLParameters(self._url))
+            self._channel = self._connection.channel()
+        return self._channel
+
+    def publisher(self, max_buffer=MAX_BUFFER):
+        return PikaPublisher(self._url, max_buffer)
+
+    def publish(self, exchange, routing_key, body, content_type=None):
+        if content_type and content_type not in self._properties:
+            self._properties[content_type] = self._pika.BasicProperties(content_type=content_type)
+        self._open().basic_publish(exchange, routing_key, body, self._properties.get(content_type))
+
+    def subscribe(self, bindings, callback, no_ack=True, prefetch=None, queue=None):
+        channel = self._open()
+        if prefetch:
+            channel.basic_qos(prefetch_count=prefetch)
+        if queue:
+            channel.queue_declare(queue=queue, durable=True)
+        else:
+            queue = channel.queue_declare(exclusive=True).method.queue
+        for exchange, pattern in bindings:
+            channel.queue_bind(exchange=exchange, queue=queue, routing_key=pattern)
+
+        def on_message(ch, method, properties, body):
+            callback(Message(method.exchange, method.routing_key, properties.content_type, body,
+                             method.delivery_tag))
+        self._consumer_tag = channel.basic_consume(on_message, queue=queue, no_ack=no_ack)
+
+    def process(self, time_limit):
+        self._open()
+        self._connection.process_data_events(time_limit=time_limit)
+
+    def ack(self, tag, multiple=False):
+        self._channel.basic_ack(delivery_tag=tag, multiple=multiple)
+
+    def cancel(self):
+        if self._consumer_tag:
+            self._channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+
+    def sleep(self, seconds):
+        self._open()
+        self._connection.sleep(seconds)
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+
+#
+# Publisher for the local bus.  Sends on its own connection, so it can be
+# used from another thread than the consumer.  While the broker is down
+# messages are dropped (and counted), and the connection is retried every
+# RECONNECT_SECONDS.
+#
+class LocalPublisher(object):
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._sock = None
+        self._retry = 0
+        self.dropped = 0
+
+    def publish(self, exchange, routing_key, body, content_type=None):
+        data = frame(FRAME_PUBLISH, pack_message(exchange, routing_key, content_type, body))
+        with self._lock:
+            if self._sock is None and time.time() >= self._retry:
+                try:
+                    self._sock = connect(self._path)
+                except socket.error, e:
+                    print "WARNING: could not connect to local bus %s, retrying in %d seconds: %s" % (
+                        self._path, RECONNECT_SECONDS, e)
+                    self._retry = time.time() + RECONNECT_SECONDS
+            if self._sock is not None:
+                try:
+                    self._sock.sendall(data)
+                    return
+                except socket.error, e:
+                    print "WARNING: local bus connection lost: %s" % e
+                    self._sock.close()
+                    self._sock = None
+                    self._retry = time.time() + RECONNECT_SECONDS
+            self.dropped += 1
+
+    def buffered(self):
+        return 0
+
+    def close(self):
+        with self._lock:
+            if self._sock:
+                self._sock.close()
+                self._sock = None
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+class LocalTransport(object):
+    def __init__(self, path):
+        self._path = path
+        self._sock = None
+        self._buf = ''
+        self._callback = None
+
+    def _open(self):
+        if self._sock is None:
+            self._sock = connect(self._path)
+        return self._sock
+
+    def publisher(self, max_buffer=MAX_BUFFER):
+        return LocalPublisher(self._path)
+
+    def publish(self, exchange, routing_key, body, content_type=None):
+        self._open().sendall(frame(FRAME_PUBLISH, pack_message(exchange, routing_key, content_type, body)))
+
+    def subscribe(self, bindings, callback, no_ack=True, prefetch=None, queue=None):
+        self._callback = callback
+        sock = self._open()
+        for exchange, pattern in bindings:
+            exchange, pattern = utf8(exchange), utf8(pattern)
+            sock.sendall(frame(FRAME_BIND, BIND_STRUCT.pack(prefetch or 0, 1 if no_ack else 0, len(exchange)) +
+                               exchange + pattern))
+
+    def process(self, time_limit):
+        sock = self._open()
+        deadline = time.time() + (time_limit or 0)
+        while True:
+            r, w, x = select.select([sock], [], [], max(0, deadline - time.time()))
+            if r:
+                data = sock.recv(1 << 18)
+                if not data:
+                    raise IOError('local bus %s closed the connection' % self._path)
+                frames, self._buf = read_frames(self._buf + data)
+                for kind, payload in frames:
+                    if kind == FRAME_DELIVER and self._callback:
+                        tag = TAG_STRUCT.unpack_from(payload)[0]
+                        exchange, routing_key, content_type, body = unpack_message(payload, TAG_STRUCT.size)
+                        self._callback(Message(exchange, routing_key, content_type, body, tag))
+            if time.time() >= deadline:
+                break
+
+    def ack(self, tag, multiple=False):
+        self._open().sendall(frame(FRAME_ACK, ACK_STRUCT.pack(tag, 1 if multiple else 0)))
+
+    def cancel(self):
+        self._open().sendall(frame(FRAME_CANCEL))
+        self._callback = None
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+
+#
+# One connection to the local broker: its bindings, and (if it subscribed)
+# its queue of messages not yet delivered and the tags not yet acked.
+#
+class BrokerClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.out = []
+        self.bindings = []
+        self.queue = deque()
+        self.unacked = deque()
+        self.prefetch = 0
+        self.no_ack = True
+        self.tag = 0
+        self.dropped = 0
+
+    def bound(self, exchange, routing_key):
+        for e, pattern in self.bindings:
+            if e == exchange and topic_match(pattern, routing_key):
+                return True
+        return False
+
+    def deliver(self):
+        while self.queue and len(self.out) < MAX_OUT and \
+                (self.no_ack or not self.prefetch or len(self.unacked) < self.prefetch):
+            self.tag += 1
+            self.out.append(frame(FRAME_DELIVER, TAG_STRUCT.pack(self.tag) + self.queue.popleft()))
+            if not self.no_ack:
+                self.unacked.append(self.tag)
+
+    def ack(self, tag, multiple):
+        if multiple:
+            while self.unacked and self.unacked[0] <= tag:
+                self.unacked.popleft()
+        elif tag in self.unacked:
+            self.unacked.remove(tag)
+        self.deliver()
+
+
+class LocalBroker(object):
+    def __init__(self, path):
+        self._path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(64)
+        self._listener.setblocking(0)
+        self._clients = {}
+        self.published = 0
+
+    def run(self):
+        try:
+            while True:
+                writers = [c.sock for c in self._clients.values() if c.out]
+                r, w, x = select.select([self._listener] + self._clients.keys(), writers, [], 1.0)
+                for sock in r:
+                    if sock is self._listener:
+                        self._accept()
+                    elif sock in self._clients:
+                        self._read(self._clients[sock])
+                for sock in w:
+                    if sock in self._clients:
+                        self._write(self._clients[sock])
+        finally:
+            self._listener.close()
+            os.unlink(self._path)
+
+    def _accept(self):
+        try:
+            sock, addr = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self._clients[sock] = BrokerClient(sock)
+
+    def _drop(self, client):
+        del self._clients[client.sock]
+        client.sock.close()
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(1 << 18)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._drop(client)
+            return
+        frames, client.buf = read_frames(client.buf + data)
+        for kind, payload in frames:
+            if kind == FRAME_PUBLISH:
+                self._publish(payload)
+            elif kind == FRAME_ACK:
+                client.ack(*ACK_STRUCT.unpack(payload))
+            elif kind == FRAME_BIND:
+                prefetch, no_ack, le = BIND_STRUCT.unpack_from(payload)
+                exchange = payload[BIND_STRUCT.size:BIND_STRUCT.size + le]
+                client.bindings.append((exchange, payload[BIND_STRUCT.size + le:]))
+                client.prefetch, client.no_ack = prefetch, bool(no_ack)
+            elif kind == FRAME_CANCEL:
+                client.bindings = []
+                client.queue.clear()
+
+    def _publish(self, payload):
+        self.published += 1
+        exchange, routing_key, content_type, body = unpack_message(payload)
+        for client in self._clients.values():
+            if client.bindings and client.bound(exchange, routing_key):
+                if len(client.queue) >= MAX_QUEUE:
+                    client.queue.popleft()
+                    client.dropped += 1
+                client.queue.append(payload)
+                client.deliver()
+
+    def _write(self, client):
+        data = ''.join(client.out)
+        try:
+            n = client.sock.send(data)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop(client)
+            return
+        client.out = [data[n:]] if n < len(data) else []
+        client.deliver()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Local message bus')
+    parser.add_argument('socket', help='Unix socket path to listen on (clients use local://<path>)')
+    args = parser.parse_args()
+
+    broker = LocalBroker(args.socket)
+    print "Local bus listening on %s" % args.socket
+    broker.run()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit, se:
+        print "ERROR:", se
@@ -0,0 +1,140 @@
+#
+# Message encodings on the zlogger exchange.
+#
+# Messages are JSON unless their content_type says otherwise.  POS/TELE
+# rows may instead use a fixed binary layout, versioned both by the
+# content type and by the first byte of the body:
+#
+#   ROW_V1   version, kind, msec, riderid, location, fwd, meters, mwh,
+#            duration, elevation, speed, hr, monitorid, lpup, cad, grp,
+#            pup length, followed by pup (utf-8)
+#
+# kind says whether location is the chalkline ('lineid', for POS rows) or
+# 'rad' (TELE rows).  A None location is sent as NONE_VALUE.
+#
+# POSBATCH messages carry all the POS rows for one chalkline in a short
+# window.  As JSON they are {'line': id, 'fields': BATCH_FIELDS, 'rows':
+# [[...], ...]}; the binary form is
+#
+#   BATCH_V1  version, line, count, followed by count ROW_V1 rows
+#
+# Consumers call decode(body, properties) and get the same dict in either
+# case.
+#
+import json
+import struct
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_ROW_V1 = 'application/x-zlogger-row; version=1'
+CONTENT_TYPE_BATCH_V1 = 'application/x-zlogger-batch; version=1'
+
+ROW_V1 = 1
+ROW_V1_STRUCT = struct.Struct('<BBqiibiiiiiiiiiiB')
+BATCH_V1 = 1
+BATCH_V1_STRUCT = struct.Struct('<BiI')
+
+LOCATION_FIELDS = ('lineid', 'rad')
+NONE_VALUE = -0x80000000
+
+FORMATS = ('json', 'binary')
+
+# field order of the rows passed to encode_row, as in parse_log.MSG_FIELDS.
+ROW_FIELDS = ('msec', 'riderid', None, 'fwd', 'meters', 'mwh', 'duration', 'elevation', 'speed', 'hr',
+              'monitorid', 'lpup', 'pup', 'cad', 'grp')
+
+
+# fields of each POSBATCH row: ROW_FIELDS without the chalkline.
+BATCH_FIELDS = ROW_FIELDS[:2] + ROW_FIELDS[3:]
+
+
+def row_dict(location_field, params):
+    return dict(zip([location_field if f is None else f for f in ROW_FIELDS], params))
+
+
+def encode_json(data):
+    return json.dumps(data), CONTENT_TYPE_JSON
+
+
+#
+# Returns (body, content_type) for a POS/TELE row.  Rows the binary layout
+# cannot hold exactly (non-integer values, long pup) are sent as JSON.
+#
+def encode_row(location_field, params, format='json'):
+    body = encode_row_v1(location_field, params) if format == 'binary' else None
+    if body is not None:
+        return body, CONTENT_TYPE_ROW_V1
+    return encode_json(row_dict(location_field, params))
+
+
+# Returns the ROW_V1 body, or None if the row does not fit the layout.
+def encode_row_v1(location_field, params):
+    (msec, riderid, location, fwd, meters, mwh, duration, elevation, speed, hr,
+     monitorid, lpup, pup, cad, grp) = params
+    if isinstance(pup, unicode):
+        pup = pup.encode('utf-8')
+    values = (msec, riderid, NONE_VALUE if location is None else location, fwd, meters, mwh,
+              duration, elevation, speed, hr, monitorid, lpup, cad, grp)
+    if len(pup) >= 256 or any(type(v) is float for v in values):
+        return None
+    try:
+        return ROW_V1_STRUCT.pack(ROW_V1, LOCATION_FIELDS.index(location_field),
+                                  *(values + (len(pup),))) + pup
+    except struct.error:
+        return None
+
+
+#
+# Returns (body, content_type) for a POSBATCH of the POS rows (params as
+# for encode_row) crossing one chalkline.
+#
+def encode_batch(line_id, rows, format='json'):
+    if format == 'binary':
+        bodies = [encode_row_v1('lineid', params) for params in rows]
+        if None not in bodies:
+            return (BATCH_V1_STRUCT.pack(BATCH_V1, line_id, len(bodies)) + ''.join(bodies),
+                    CONTENT_TYPE_BATCH_V1)
+    return encode_json({'line': line_id, 'fields': BATCH_FIELDS,
+                        'rows': [params[:2] + params[3:] for params in rows]})
+
+
+def unpack_row_v1(body, offset=0):
+    v = ROW_V1_STRUCT.unpack_from(body, offset)
+    if v[0] != ROW_V1:
+        raise ValueError('unsupported row version %d' % v[0])
+    start = offset + ROW_V1_STRUCT.size
+    pup = body[start:start + v[16]].decode('utf-8')
+    return v, pup, start + v[16]
+
+
+def decode_row_v1(body):
+    v, pup, end = unpack_row_v1(body)
+    location = v[4] if v[4] != NONE_VALUE else None
+    return {'msec': v[2], 'riderid': v[3], LOCATION_FIELDS[v[1]]: location, 'fwd': v[5],
+            'meters': v[6], 'mwh': v[7], 'duration': v[8], 'elevation': v[9], 'speed': v[10],
+            'hr': v[11], 'monitorid': v[12], 'lpup': v[13], 'cad': v[14], 'grp': v[15], 'pup': pup}
+
+
+def decode_batch_v1(body):
+    version, line_id, count = BATCH_V1_STRUCT.unpack_from(body)
+    if version != BATCH_V1:
+        raise ValueError('unsupported batch version %d' % version)
+    rows = []
+    offset = BATCH_V1_STRUCT.size
+    for i in xrange(count):
+        v, pup, offset = unpack_row_v1(body, offset)
+        rows.append([v[2], v[3], v[5], v[6], v[7], v[8], v[9], v[10], v[11], v[12], v[13], pup, v[14], v[15]])
+    return {'line': line_id, 'fields': list(BATCH_FIELDS), 'rows': rows}
+
+
+DECODERS = {
+    CONTENT_TYPE_ROW_V1: decode_row_v1,
+    CONTENT_TYPE_BATCH_V1: decode_batch_v1,
+}
+
+
+def decode(body, properties=None):
+    content_type = getattr(properties, 'content_type', None)
+    decoder = DECODERS.get(content_type)
+    if decoder:
+        return decoder(body)
+    return json.loads(body)